@@ -34,8 +34,10 @@
 # Its main purpose is to build a local database of Solidity smart contracts and
 # their versions.
 
-import os, sys, argparse, shutil, time, signal
-import sqlite3, csv
+import os, sys, argparse, shutil, time, signal, json, math, random
+import sqlite3, csv, threading, queue, zlib, hashlib, urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 import requests
 
 # Before we get to the fun stuff, we need to parse and validate arguments, check
@@ -76,9 +78,22 @@ parser.add_argument('--no-throttle', dest='throttle', action='store_false',
 parser.add_argument('--search-forks', dest='forks', action='store_true', 
     help='''add 'fork:true' to query which includes forked repos in the result''')
 
+parser.add_argument('--workers', metavar='N', type=int, default=16,
+    help='''number of concurrent downloads from the raw content API 
+    (default: 16)''')
+
+parser.add_argument('--compress', action='store_true', 
+    help='''store the file contents zlib-compressed as BLOBs instead of as 
+    plain text''')
+
+parser.add_argument('--enable-fts', dest='fts', action='store_true', 
+    help='''maintain a full-text (trigram) index of the file contents in the 
+    table 'blob_fts' (makes inserts slower)''')
+
 parser.add_argument('--github-token', metavar='TOKEN', 
     default=os.environ.get('GITHUB_TOKEN'), 
-    help='''personal access token for GitHub 
+    help='''personal access token for GitHub; several tokens can be separated 
+    by commas to combine their rate limits
     (by default, the environment variable GITHUB_TOKEN is used)''')
 
 args = parser.parse_args()
@@ -93,6 +108,16 @@ if args.max_size > MAX_FILE_SIZE:
     sys.exit(f'max-size must be less than or equal to {MAX_FILE_SIZE}')
 if args.stratum_size < 1:
     sys.exit('stratum-size must be positive')
+if args.workers < 1:
+    sys.exit('workers must be positive')
+if args.fts and args.compress:
+    sys.exit('enable-fts can not be used together with compress')
+
+# Spaces around the tokens and empty entries (e.g. from a trailing comma) would
+# end up in the authorization header, so they are removed right away.
+args.github_token = ','.join(token.strip() for token in 
+    (args.github_token or '').split(',') if token.strip())
+
 if not args.github_token:
     confirm_no_token = input('''No GitHub TOKEN was specified or found in the environment variables.
 Do you want to run the program without a token (this will slow the program down)? [y/N]\n''')
@@ -112,10 +137,14 @@ Do you want to run the program without a token (this will slow the program down)
 # our case are non-overlapping file size ranges.
 
 # Let's start with some global definitions. We need to keep track of the first
-# and last size in the current stratum...
+# and last size in the current stratum. The last size always follows from the
+# first one, only the last stratum may be cut short by the maximum size...
+
+def stratum_last(first):
+    return min(first + args.stratum_size - 1, args.max_size)
 
 strat_first = args.min_size
-strat_last = min(args.min_size + args.stratum_size - 1, args.max_size)
+strat_last = stratum_last(strat_first)
 
 # ...as well as the current stratum's population of repositories and the amount
 # of repositories/files/commits that have been sampled so far (in the current 
@@ -142,6 +171,43 @@ start = time.time()
 rate_used = 0
 api_calls = 0
 
+# For the request throttling we remember when the last API call was made and,
+# for each token and each of GitHub's rate limit resources (e.g. 'core' or
+# 'code_search'), how many calls are remaining and when the limit will be reset.
+
+last_call = 0
+rate_limits = {}
+
+# Every token has its own rate limits, so several tokens can be used together to
+# make more calls. Without a token, there is just a single anonymous one.
+
+tokens = args.github_token.split(',') if args.github_token else [None]
+
+# When the program is interrupted (Ctrl-C or SIGTERM, see the signal handler
+# below), the signal handler only sets 'interrupted'. The KeyboardInterrupt is
+# raised by the main thread itself, whenever it waits for something (a response,
+# the terminal or the end of a pause). That way, it never happens in the middle
+# of taking or releasing a lock of one of the thread pools or queues.
+
+INTERRUPT_POLL = 0.1
+interrupted = False
+
+def check_interrupt():
+    if interrupted and not stopping.is_set():
+        raise KeyboardInterrupt
+
+def wait_for(future):
+    check_interrupt()
+    while not wait([future], timeout=INTERRUPT_POLL).done:
+        check_interrupt()
+    return future.result()
+
+def pause(t):
+    end = time.monotonic() + t
+    while time.monotonic() < end:
+        check_interrupt()
+        time.sleep(min(INTERRUPT_POLL, max(0, end - time.monotonic())))
+
 #-------------------------------------------------------------------------------
 
 # During the search we want to display a table of all the strata sampled so far,
@@ -149,19 +215,80 @@ api_calls = 0
 # status message. These last three items will be continuously updated to signal
 # the progress that's being made.
 
+# Writing to the terminal can be slow (e.g. when the output is piped somewhere),
+# so the scraper itself never writes to it directly. Instead, 'output' hands the
+# text to a background thread, which writes everything that has piled up in one
+# go. Before printing anything else, 'flush_output' waits until all of it has
+# been written: it sends an event through the queue, which the thread sets once
+# it got there. Unlike joining a 'queue.Queue', waiting for the event can be
+# interrupted.
+
+# If the output can't be written anymore (e.g. because it is piped into 'head',
+# which has exited), the scraper goes on and everything from then on is written
+# to /dev/null instead, including the messages printed at the very end.
+
+ui_queue = queue.SimpleQueue()
+
+def output(text):
+    ui_queue.put(text)
+
+def flush_output():
+    done = threading.Event()
+    ui_queue.put(done)
+    check_interrupt()
+    while not done.wait(INTERRUPT_POLL):
+        if not ui_thread.is_alive():
+            return
+        check_interrupt()
+
+def ui_worker():
+    while True:
+        items = [ui_queue.get()]
+        while True:
+            try:
+                items.append(ui_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            sys.stdout.write(''.join(item for item in items if isinstance(item, str)))
+            sys.stdout.flush()
+        except OSError:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            os.close(devnull)
+        finally:
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+ui_thread = threading.Thread(target=ui_worker, daemon=True)
+ui_thread.start()
+
+# The live progress only makes sense in a terminal. When the output goes to a
+# file or a pipe instead (e.g. for long runs in the background), all the cursor
+# movements would just end up in there as garbage. In that case, each stratum is
+# printed once when it is done, and the footer once at the very end.
+
+LIVE_UI = sys.stdout.isatty()
+
 # First, let's just print the table header.
 
-print('                 ┌────────────┬────────────┬────────────┬────────────┐')
-print('                 │  pop file  │  sam repo  │  sam file  │ sam commit │')
-print('                 ├────────────┼────────────┼────────────┼────────────┤')
+output('                 ┌────────────┬────────────┬────────────┬────────────┐\n'
+       '                 │  pop file  │  sam repo  │  sam file  │ sam commit │\n'
+       '                 ├────────────┼────────────┼────────────┼────────────┤\n')
 
 # Now we define some functions to print information about the current stratum.
 # By default, this will simply add a new line to the output. However, to be able
 # to show live progress, there is also an option to overwrite the current line.
+# To overwrite lines, the cursor is moved up to the beginning of the first one
+# and everything from there on is cleared.
 
-def print_stratum(overwrite=False):
-    if overwrite:
-        sys.stdout.write('\033[F\r\033[J')
+CLEAR_LINE = '\033[F\r\033[J'
+
+def clear_lines(n):
+    return f'\033[{n}F\r\033[J'
+
+def format_stratum():
     if strat_first == strat_last:
         size = '%d' % strat_first
     else:
@@ -171,35 +298,78 @@ def print_stratum(overwrite=False):
     sam_file_str = str(sam_file) if sam_file > -1 else ''
     sam_comit_str = str(sam_comit) if sam_comit > -1 else ''
     per = '%6.2f%%' % (sam_repo/pop_files*100) if pop_files > 0 else ''
-    print('%16s │ %10s │ %10s │ %10s │ %10s │ %6s' % (size, pop_str, sam_repo_str, 
-        sam_file_str, sam_comit_str, per))
+    return '%16s │ %10s │ %10s │ %10s │ %10s │ %6s\n' % (size, pop_str, 
+        sam_repo_str, sam_file_str, sam_comit_str, per)
+
+def print_stratum(overwrite=False):
+    output((CLEAR_LINE if overwrite else '') + format_stratum())
+
+def finish_stratum():
+    if not LIVE_UI:
+        print_stratum()
 
 # Another function will print the footer of the table, including summary
 # statistics and the status message. Here we provide a separate function to
-# clear the footer again.
+# clear the footer again. We remember how many lines the footer took up so that
+# exactly these lines are cleared.
 
 status_msg = ''
+footer_height = 0
 
-def print_footer():
-    if args.min_size == args.max_size:
-        size = '%d' % args.min_size
-    else:
-        size = '%d .. %d' % (args.min_size, args.max_size)
+FOOTER_TABLE = '''\
+                 ├────────────┼────────────┼────────────┼────────────┤
+                 │  pop file  │  sam repo  │  sam file  │ sam commit │
+                 └────────────┴────────────┴────────────┴────────────┘
+'''
+
+if args.min_size == args.max_size:
+    FOOTER_SIZE = '%d' % args.min_size
+else:
+    FOOTER_SIZE = '%d .. %d' % (args.min_size, args.max_size)
+
+def format_footer():
     tot_sam_repo_str = str(total_sam_repo) if total_sam_repo > -1 else ''
     tot_sam_file_str = str(total_sam_file) if total_sam_file > -1 else ''
     tot_sam_comit_str = str(total_sam_comit) if total_sam_comit > -1 else ''
-    print('                 ├────────────┼────────────┼────────────┼────────────┤')
-    print('                 │  pop file  │  sam repo  │  sam file  │ sam commit │')
-    print('                 └────────────┴────────────┴────────────┴────────────┘')
-    print('%16s   %10s   %10s   %10s   %10s   %6s' % (size, '', tot_sam_repo_str,
-        tot_sam_file_str, tot_sam_comit_str, ''))
-    print()
-    print('Current GitHub ratelimit: %d / ~5000' % (rate_used))
-    print()
-    print(status_msg)
+    return (FOOTER_TABLE + 
+        '%16s   %10s   %10s   %10s   %10s   %6s\n' % (FOOTER_SIZE, '', 
+            tot_sam_repo_str, tot_sam_file_str, tot_sam_comit_str, '') +
+        '\nCurrent GitHub ratelimit: %d / ~5000\n\n' % (rate_used) +
+        status_msg + '\n')
+
+def print_footer():
+    global footer_height
+    if not LIVE_UI:
+        return
+    footer = format_footer()
+    footer_height = footer.count('\n')
+    output(footer)
 
 def clear_footer():
-    sys.stdout.write(f'\033[9F\r\033[J')
+    if LIVE_UI:
+        output(clear_lines(footer_height))
+
+# Updating the current stratum means clearing the footer, (over)writing the
+# stratum line and printing the footer again. 'redraw' builds this whole frame
+# first and writes it to the terminal at once. Inside the download loops, where
+# this happens for every single item, 'force=False' limits the repaints to a few
+# per second.
+
+REDRAW_INTERVAL = 0.2
+last_redraw = 0
+
+def redraw(overwrite=True, force=True):
+    global last_redraw, footer_height
+    if not LIVE_UI:
+        return
+    now = time.monotonic()
+    if not force and now - last_redraw < REDRAW_INTERVAL:
+        return
+    last_redraw = now
+    footer = format_footer()
+    output(clear_lines(footer_height) + 
+        (CLEAR_LINE if overwrite else '') + format_stratum() + footer)
+    footer_height = footer.count('\n')
 
 # For convenience, we also have function for just updating the status message.
 # It returns the old message so it can be restored later if desired.
@@ -208,96 +378,313 @@ def update_status(msg):
     global status_msg
     old_msg = status_msg
     status_msg = msg
-    sys.stdout.write('\033[F\r\033[J')
-    print(status_msg)
+    if LIVE_UI:
+        output(CLEAR_LINE + status_msg + '\n')
     return old_msg
 
 #-------------------------------------------------------------------------------
 
-# To access the GitHub API, we define a little helper function that makes an
-# authorized GET request and throttles the number of requests per second so as
-# not to run afoul of GitHub's rate limiting. Should a rate limiting error occur
-# nonetheless, the function waits the appropriate amount of time before
-# automatically retrying the request.
+# All requests go through one of two persistent sessions, one for the GitHub API
+# and one for the raw content API. This way the underlying TCP/TLS connections
+# are kept alive and reused instead of setting up a new connection for every
+# single request. The authorization header only needs to be set once.
+
+REQUEST_TIMEOUT = 30
+
+def create_session(headers={}):
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, 
+        pool_maxsize=max(16, args.workers))
+    session.mount('https://', adapter)
+    return session
+
+api_sessions = {token: create_session({} if token is None else 
+    {'Authorization': f'token {token}'}) for token in tokens}
+raw_session = create_session()
+
+def close_sessions():
+    for session in api_sessions.values():
+        session.close()
+    raw_session.close()
+
+# To access the GitHub API, 'submit_get' makes an authorized GET request and
+# throttles the number of requests per second so as not to run afoul of GitHub's
+# rate limiting. Should a rate limiting error occur nonetheless, 'get_result'
+# waits the appropriate amount of time before automatically retrying the request.
+
+# The requests themselves are sent from a small pool of worker threads. This
+# allows us to request e.g. the commit lists of the next few files while we are
+# still busy with the current one. The throttle is shared by all workers, so the
+# requests still go out one after another and only their waiting times overlap.
+# Everything else (counting, logging, handling errors) happens on the main
+# thread in 'get_result'. Every request is made with 'submit_get' as early as
+# possible and picked up with 'get_result' once it is needed, so most responses
+# are fetched ahead of time.
+
+API_WORKERS = 4
+
+api_pool = ThreadPoolExecutor(max_workers=API_WORKERS)
+throttle_lock = threading.Lock()
+stopping = threading.Event()
+
+# Instead of sleeping a fixed amount of time before every request, the throttle
+# spreads the remaining calls of a rate limit resource evenly over the time until
+# the limit is reset. With several tokens, the calls per second of all tokens add
+# up. Time that has already passed since the last call (e.g. while waiting for
+# the response) is not slept again. As long as we know nothing about the rate
+# limit of a token, we fall back to the 5000 (or 60 without a token) calls per
+# hour. If all tokens are used up, we wait for the first one to be reset.
+
+# Which resource a request is charged to is reported by GitHub in the
+# 'X-RateLimit-Resource' header (e.g. 'code_search' for the code search). So we
+# remember it for each kind of request (the search type for searches, the first
+# part of the path otherwise). Until the first response of a kind has arrived,
+# the kind itself stands in for the resource.
+
+resources = {}
+
+def request_kind(url):
+    parts = urllib.parse.urlsplit(url).path.split('/')
+    return '/'.join(parts[:3] if parts[1:2] == ['search'] else parts[:2])
+
+def rate_limit_resource(url):
+    kind = request_kind(url)
+    return resources.get(kind, kind)
+
+def throttle(url):
+    resource = rate_limit_resource(url)
+    now = time.time()
+    rate = 0
+    for token in tokens:
+        if (token, resource) in rate_limits:
+            remaining, reset = rate_limits[(token, resource)]
+            rate += remaining / max(1, reset - now)
+        else:
+            rate += 1 / 60 if token is None else 1 / 0.72
+    interval = 1 / rate if rate > 0 else reset_wait(resource)
+    wait = interval - (time.time() - last_call)
+    if wait > 0:
+        stopping.wait(wait)
+
+def reset_wait(resource):
+    limits = [rate_limits.get((token, resource)) for token in tokens]
+    if any(limit is None or limit[0] > 0 for limit in limits):
+        return 0
+    return max(0, min(reset for (_, reset) in limits) - time.time())
+
+# Each request is made with the token that has the most calls remaining, so the
+# tokens are used up evenly. Tokens that we know nothing about yet come first.
+
+def pick_token(url):
+    resource = rate_limit_resource(url)
+    return max(tokens,
+        key=lambda token: rate_limits.get((token, resource), (math.inf,))[0])
+
+def update_rate_limits(token, res):
+    resource = res.headers.get('X-RateLimit-Resource')
+    remaining = res.headers.get('X-RateLimit-Remaining')
+    reset = res.headers.get('X-RateLimit-Reset')
+    if resource is not None and remaining is not None and reset is not None:
+        resources[request_kind(res.url)] = resource
+        rate_limits[(token, resource)] = (int(remaining), int(reset))
+
+# Connection problems, timeouts and server errors are often only temporary, so
+# the workers retry a request a few times, waiting a little longer each time,
+# before they report the error. A random fraction of a second is added to each
+# wait, so that the workers that failed at the same time don't all retry at the
+# same moment again.
+
+RETRIES = 3
+
+def send(session, url, params={}, headers=None):
+    for attempt in range(RETRIES):
+        try:
+            res = session.get(url, params=params, headers=headers,
+                timeout=REQUEST_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == RETRIES - 1 or stopping.is_set():
+                raise
+        else:
+            if res.status_code < 500 or attempt == RETRIES - 1:
+                return res
+        stopping.wait(2 ** attempt + random.random())
+
+# When a previous search is continued, it starts again with the stratum it was
+# interrupted in and requests the same search pages another time. GitHub answers
+# a conditional request ('If-None-Match') with '304 Not Modified' if the result
+# has not changed, and such responses do not count against the rate limit. So we
+# keep the ETag, the 'Link' header and the body of the search pages of the
+# current stratum in the 'etag' table (see below) and use the stored page
+# whenever we get a 304. The commit lists of known files are never requested
+# again and the raw content API has no rate limit anyway, so only search pages
+# are cached.
+
+def cacheable(url):
+    return url.startswith('https://api.github.com/search/')
+
+def request(url, params):
+    global last_call
+    headers = None
+    if cacheable(url):
+        etag = stored_etag(requests.Request('GET', url, params=params).prepare().url)
+        if etag is not None:
+            headers = {'If-None-Match': etag}
+    with throttle_lock:
+        if args.throttle:
+            throttle(url)
+        if stopping.is_set():
+            return None
+        last_call = time.time()
+        token = pick_token(url)
+    res = send(api_sessions[token], url, params, headers)
+    update_rate_limits(token, res)
+    return res
+
+def submit_get(url, params={}):
+    return api_pool.submit(request, url, params)
 
-def get(url, params={}):
+def get_result(future, attempt=0):
     global api_calls, rate_used
-    if args.throttle:
-        sleep = 60 if not args.github_token else 0.72
-        time.sleep(sleep)
-    auth_headers = {} if not args.github_token else {'Authorization': f'token {args.github_token}'}
     try:
-        res = requests.get(url, params, headers=auth_headers)
-    except requests.ConnectionError:
+        res = wait_for(future)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        handle_log_exception(e)
+        flush_output()
         print("\nERROR :: There seems to be a problem with your internet connection.")
-        return signal_handler(0,0)
+        raise KeyboardInterrupt
     api_calls += 1
-    rate_used = (int(res.headers.get('X-RateLimit-Used')) if
-        res.headers.get('X-RateLimit-Used') != None else 0)
-    if res.status_code == 403:
+    used = res.headers.get('X-RateLimit-Used')
+    rate_used = int(used) if used is not None else 0
+    if res.status_code in (403, 429):
         clear_footer()
         print_footer()
-        return handle_rate_limit_error(res)
+        return handle_rate_limit_error(res, attempt)
+    elif res.status_code == 304 and cacheable(res.url):
+        return restore_page(res)
     else:
         if res.status_code != 200:
             handle_log_response(res)
         res.raise_for_status()
+        if cacheable(res.url) and 'ETag' in res.headers:
+            store_page(res)
         return res
 
-def handle_rate_limit_error(res):
-    t = res.headers.get('X-RateLimit-Reset')
-    if t is not None:
-        t = max(0, int(int(t) - time.time()))
-    else: 
-        t = int(res.headers.get('Retry-After', 60))
+# GitHub tells us how long to wait in different ways: the secondary rate limits
+# send a 'Retry-After' header, while an exhausted primary rate limit has no
+# remaining calls until 'X-RateLimit-Reset'. If neither is the case, we back off
+# exponentially and eventually give up, since the 403 might not be caused by a
+# rate limit at all (e.g. a repository that we are not allowed to access). Here,
+# too, some random jitter is added to the wait. Since the reset time is given
+# in whole seconds, this also keeps us from retrying just before the reset.
+# With several tokens, we only have to wait if none of them has calls left for
+# the resource that the response was charged to. If we know nothing about that
+# resource, the reset time of the response itself is used. Should the reset be
+# due already, we still wait a second for GitHub to catch up.
+
+RATE_LIMIT_RETRIES = 6
+
+def handle_rate_limit_error(res, attempt=0):
+    retry_after = res.headers.get('Retry-After')
+    remaining = res.headers.get('X-RateLimit-Remaining')
+    reset = res.headers.get('X-RateLimit-Reset')
+    if retry_after is not None:
+        t = int(retry_after)
+    elif remaining == '0' and reset is not None:
+        resource = res.headers.get('X-RateLimit-Resource') or rate_limit_resource(res.url)
+        if any((token, resource) in rate_limits for token in tokens):
+            t = reset_wait(resource)
+        else:
+            t = max(0, int(reset) - time.time())
+        if t == 0 and int(reset) <= time.time():
+            t = 1
+        t = math.ceil(t)
+    elif attempt < RATE_LIMIT_RETRIES:
+        t = 2 ** attempt
+    else:
+        handle_log_response(res)
+        res.raise_for_status()
     err_msg = f'Exceeded rate limit. Retrying after {t} seconds...'
     if not args.github_token:
         err_msg += ' Try running the script with a GitHub TOKEN.'
     old_msg = update_status(err_msg)
-    time.sleep(t)
+    pause(t + random.random() if t > 0 else 0)
     update_status(old_msg)
-    return get(res.url)
+    return get_result(submit_get(res.url), attempt + 1)
 
 # In order to reduce the amount of GitHub API calls further we use the raw content API
 # from GitHub to request the content of the single commits. This also reduces the need
-# to throttle and hence makes the script theoretically faster. We define a function that
-# helps to request data from the 'raw.githubusercontent.com/' API.
+# to throttle and hence makes the script theoretically faster. Since the raw content
+# API is not rate limited, the downloads are independent of each other and most of
+# the time is spent waiting for the network, we run them concurrently on a pool of
+# worker threads. 'submit_content' schedules a download from the 
+# 'raw.githubusercontent.com/' API and 'get_content' waits for it to finish. The
+# response is only inspected on the main thread, so that the status message and the
+# log-file are never touched by the workers.
+
+raw_pool = ThreadPoolExecutor(max_workers=args.workers)
+
+def submit_content(url):
+    return raw_pool.submit(send, raw_session, url)
 
-def get_content(url):
+def get_content(future):
     try:
-        res = requests.get(url)
-    except requests.ConnectionError:
+        res = wait_for(future)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        handle_log_exception(e)
+        flush_output()
         print("\nERROR :: There seems to be a problem with your internet connection.")
-        return signal_handler(0,0)
+        raise KeyboardInterrupt
     if res.status_code != 200:
         handle_log_response(res)
     res.raise_for_status()
     return res
 
 # This helper function can be used to write information on the Response from a request 
-# into a log-file (default: log.txt).
+# (or on the error that kept us from getting one) into a log-file (log.txt). The
+# file is only opened once, when the first error occurs, and line-buffered, so
+# every entry is on disk right after it's written.
+# The error stays in the status line until the next status update, instead of
+# holding up the downloads to show it.
 
-def handle_log_response(res,file="log.txt"):
-    err_msg = f'Request response error with status: {res.status_code} (for details see {file})'
-    old_msg = update_status(err_msg)
-    logger = open(file, "a")
+LOG_FILE = 'log.txt'
+log_file = None
+
+def handle_log_response(res):
+    message = None
+    if res.status_code != 200:
+        # The raw content API does not answer with JSON
+        try:
+            message = res.json()['message']
+        except (ValueError, KeyError, TypeError):
+            message = res.text
+    log_error(res.url, res.status_code, message)
+
+def handle_log_exception(e):
+    url = e.request.url if e.request is not None else None
+    log_error(url, type(e).__name__, str(e))
+
+def log_error(url, status, message=None):
+    global log_file
+    err_msg = f'Request response error with status: {status} (for details see {LOG_FILE})'
+    update_status(err_msg)
+    if log_file is None:
+        log_file = open(LOG_FILE, 'a', buffering=1)
     logging_str =  "\n\nTime: " + time.strftime("%m/%d/%Y, %H:%M:%S", time.localtime()) 
-    logging_str += "\nRequest: " + str(res.url) + "\nStatus: "+ str(res.status_code)
-    logging_str += "\nMessage: " + res.json()['message'] if res.status_code != 200 else ''
-    logger.write(logging_str)
-    logger.close()
-    time.sleep(1.5)
-    update_status(old_msg)
+    logging_str += "\nRequest: " + str(url) + "\nStatus: "+ str(status)
+    if message is not None:
+        logging_str += "\nMessage: " + message
+    log_file.write(logging_str)
 
 # We also define a convenient function to do the code search for a specific
 # stratum. Note that we sort the search results by how recently a file has been
 # indexed by GitHub. We append search criteria 'fork' depending on the user input 
 # to refine the search results.
 
-def search(a,b,order='asc'):
+def submit_search(a,b,order='asc'):
     q_fork = 'true' if args.forks else 'false'
 
-    return get('https://api.github.com/search/code',
+    return submit_get('https://api.github.com/search/code',
                params={'q': f'{args.query} size:{a}..{b} fork:{q_fork}',
                 'sort': 'indexed', 'order': order, 'per_page': 100})
 
@@ -318,82 +705,203 @@ def search(a,b,order='asc'):
 # Also, if any of the files or commits can not be downloaded, for whatever
 # reason, they are simply skipped over and count as not sampled.
 
+# Every response body is parsed only once. The functions that work on a page
+# therefore take the already parsed JSON next to the response itself.
+
+# The next page (of search results or commits) is requested as soon as we have
+# the current one, so that it is already there when we are done with it.
+
+def submit_next(res):
+    return submit_get(res.links['next']['url']) if 'next' in res.links else None
+
 # DOWNLOAD FILES
 
-def download_all_files(res):
-    download_files_from_page(res)
-    while 'next' in res.links:
+def download_all_files(res, page):
+    next_page = submit_next(res)
+    download_files_from_page(page)
+    while next_page is not None:
         update_status('Getting next page of search results...')
         global pop_files
-        res = get(res.links['next']['url'])
-        pop2 = res.json()['total_count']
+        res = get_result(next_page)
+        next_page = submit_next(res)
+        page = res.json()
+        pop2 = page['total_count']
         pop_files = max(pop_files,pop2)
-        download_files_from_page(res)
+        download_files_from_page(page)
         if sam_file >= pop_files:
+            if next_page is not None:
+                next_page.cancel()
             break
     update_status('')
 
-def download_files_from_page(res):
+# The commit lists of the next few files on a page are requested ahead of time,
+# so that the API workers always have something to do.
+
+COMMITS_PREFETCH = API_WORKERS
+
+# Everything that is downloaded for a page of search results is written to the
+# database in one transaction (see below). If something goes wrong in between,
+# the transaction is rolled back and the error is passed on. This includes the
+# errors of the queued writes, which is why we wait for all of them before the
+# transaction is committed.
+
+def download_files_from_page(page):
     update_status('Downloading files...')
-    for file in res.json()['items']:
-        if not known_file(file):
-            repo = file['repository']
-            insert_repo(repo)
-            file_id = insert_file(file, repo['id'])
-            download_all_commits(repo, file, file_id)
-        clear_footer()
-        print_stratum(overwrite=True)
-        print_footer()
-        if sam_file >= pop_files:
-            return
+    write_db(db.execute, 'BEGIN IMMEDIATE')
+    try:
+        queued = deque()
+        for file in page['items']:
+            if not known_file(file):
+                repo = file['repository']
+                insert_repo(repo)
+                file_id = insert_file(file, repo['id'])
+                queued.append((repo, file, file_id, submit_commits(repo, file)))
+                if len(queued) > COMMITS_PREFETCH:
+                    download_all_commits(*queued.popleft())
+            redraw(force=False)
+            if sam_file >= pop_files:
+                break
+        while queued:
+            download_all_commits(*queued.popleft())
+            redraw(force=False)
+        store_downloaded_commits()
+        sync_db()
+    except Exception:
+        db_writes.clear()
+        query_db(db.execute, 'ROLLBACK')
+        raise
+    query_db(db.execute, 'COMMIT')
+    redraw()
 
 # DOWNLOAD COMMITS 
 
-def download_all_commits(repo, file, file_id):
-    try:
-        # Get the list of commits for this file
+# The raw contents of a page of commits are downloaded in the background. We
+# only wait for them right after the next (throttled) GitHub API call, so that
+# the raw downloads overlap with the API calls instead of taking turns with them.
+
+pending_commits = []
+
+# The content of a file at a specific commit is the same in every repo that
+# contains this commit, e.g. in forks. Before downloading it, we check whether we
+# already have stored (or are about to store) a commit with the same sha for the
+# same path and refer to its blob instead. The stored ones are kept in memory
+# (see 'known_contents' below), so that this check never has to wait for the
+# database.
+
+pending_contents = {}
+
+# The commits URL of a repo (without the '{/sha}' template) is the same for all
+# of its files, so we compute it only once per repo.
+
+commits_urls = {}
+
+def submit_commits(repo, file):
+    # Request the list of commits for this file
+    commits_url = commits_urls.get(repo['id'])
+    if commits_url is None:
         commits_url = repo['commits_url'][:-6].replace('#', '%23')
-        commits_res = get(commits_url, params={'path': file['path'], 'per_page': 100})
-    except Exception:
+        commits_urls[repo['id']] = commits_url
+    return submit_get(commits_url, params={'path': file['path'], 'per_page': 100})
+
+def download_all_commits(repo, file, file_id, future):
+    try:
+        commits_res = get_result(future)
+    except requests.RequestException:
         return
+    next_page = submit_next(commits_res)
+    store_downloaded_commits()
     download_commits_from_page(commits_res, repo['full_name'],
                                 file['path'], file_id)
-    while 'next' in commits_res.links:
+    while next_page is not None:
         update_status('Getting next page of commits...')
-        commits_res = get(commits_res.links['next']['url'])
+        try:
+            commits_res = get_result(next_page)
+        except requests.RequestException:
+            break
+        next_page = submit_next(commits_res)
+        store_downloaded_commits()
         download_commits_from_page(commits_res, repo['full_name'],
                                     file['path'], file_id)
     update_status('')
 
 def download_commits_from_page(commits_res, repo_full_name, file_path, file_id):
-    count_commits = str(len(commits_res.json())) if len(commits_res.json()) < 100 else "100+"
+    commits = commits_res.json()
+    count_commits = str(len(commits)) if len(commits) < 100 else "100+"
     update_status('Downloading ' + count_commits + ' commits...')
-    for commit in commits_res.json():
+    for commit in commits:
         if not known_commit(commit, file_id):
-            try:
-                content_res = get_content("https://raw.githubusercontent.com/" +
+            key = (commit['sha'], file_path)
+            content = known_contents.get(key) or pending_contents.get(key)
+            if content is None:
+                content = submit_content("https://raw.githubusercontent.com/" + 
                     repo_full_name + "/" + commit['sha'] + "/" + file_path)
-            except Exception:
-                continue
+                pending_contents[key] = content
+            pending_commits.append((commit, file_id, key, content))
 
-            # Extract only shas of parents from api response
-            parents = []
-            for p in commit['parents']:
-                parents.append(p['sha'])
-            insert_commit(commit, content_res, parents, file_id)
+def store_downloaded_commits():
+    rows = []
+    for commit, file_id, key, content in pending_commits:
+        if isinstance(content, Future):
+            try:
+                content_res = get_content(content)
+            except requests.RequestException:
+                continue
+            content = (len(content_res.content), store_blob(content_res))
+            known_contents[key] = content
+
+        # Extract only shas of parents from api response
+        parents = [p['sha'] for p in commit['parents']]
+        size, blob_sha = content
+        rows.append(commit_row(commit, size, blob_sha, parents, file_id))
+    pending_commits.clear()
+    pending_contents.clear()
+    insert_blobs()
+    insert_commits(rows)
     
 
 #-------------------------------------------------------------------------------
 
 # This is a good place to open the connection to the results database, or create
 # one if it doesn't exist yet. The database schema follows the GitHub API
-# response schema. Our 'insert_repo', 'insert_file' and 'insert_comit' functions
-# directly take a JSON response dictionary. 'commit' is a reserved keyword in 
+# response schema. Our 'insert_repo' and 'insert_file' functions directly take a
+# JSON response dictionary, 'insert_commits' takes the rows built from them by
+# 'commit_row' (see below). 'commit' is a reserved keyword in 
 # sqlite, therefore the tablename is 'comit'. We also increase our 
-# counter for the sample sizes after each insertion.
+# counter for the sample sizes after each insertion. The UNIQUE constraints
+# already index files by path and commits by sha, the additional indices make it
+# fast to look up all files of a repo and all commits of a file.
+
+# The insert functions do not commit themselves. Instead, all rows of a page of
+# search results are written in a single transaction, so that we don't have to
+# wait for the disk after every single row. With a write-ahead log and relaxed
+# syncing, a commit is cheap and the database still can't get corrupted. A
+# larger page cache (64 MB) and memory-mapped reads help with big databases. We
+# don't let sqlite3 open transactions implicitly but begin and commit them
+# ourselves, so it is always clear when the data is written.
+
+# Once the database is set up, it is only used by a single writer thread. This
+# way the downloads can go on while the rows are written to disk. 'write_db'
+# queues a statement without waiting for it, 'query_db' waits for the result
+# (which also means that all the statements before it have been executed) and
+# 'sync_db' waits for all queued statements and raises their errors, if any.
+
+db = sqlite3.connect(args.database, isolation_level=None, cached_statements=256,
+    check_same_thread=False)
+
+# Databases of older versions of this script store the content in the 'comit'
+# table itself. Before anything else is done to such a database, we take note of
+# it, so that it can be migrated when its tables are set up (see below).
+
+old_comit = 'content' in [column[1] for column in db.execute('PRAGMA table_info(comit)')]
 
-db = sqlite3.connect(args.database)
 db.executescript('''
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+    PRAGMA mmap_size=268435456;
+    ''')
+SQL_CREATE_TABLES = '''
     CREATE TABLE IF NOT EXISTS repo 
     ( repo_id INTEGER PRIMARY KEY
     , name TEXT NOT NULL
@@ -419,52 +927,230 @@ db.executescript('''
     , message TEXT NOT NULL
     , size INTEGER NOT NULL
     , created DATETIME DEFAULT CURRENT_TIMESTAMP
-    , content TEXT NOT NULL
+    , blob_sha TEXT NOT NULL
     , parents TEXT NOT NULL
     , file_id INTEGER NOT NULL
+    , FOREIGN KEY (blob_sha) REFERENCES blob(sha)
     , FOREIGN KEY (file_id) REFERENCES file(file_id)
     , UNIQUE(sha,file_id)
     );
-    ''')
+    CREATE TABLE IF NOT EXISTS blob
+    ( sha TEXT PRIMARY KEY
+    , content NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS etag
+    ( url TEXT PRIMARY KEY
+    , etag TEXT NOT NULL
+    , link TEXT
+    , body BLOB NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_file_repo ON file(repo_id);
+    CREATE INDEX IF NOT EXISTS idx_comit_file ON comit(file_id);
+    '''
+
+# To migrate an old database, its 'comit' table is renamed and the new one is
+# created next to it. Each content is then moved to the 'blob' table under its
+# git blob sha (computed from the uncompressed content, in case it was stored
+# with '--compress'), and the commits are copied over with a reference to it.
+# Parents that were stored as a Python list are turned into JSON on the way.
+# All of this happens in a single transaction, so an interrupted migration
+# leaves the database as it was.
+
+def git_blob_sha(data):
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+def stored_blob_sha(content):
+    data = zlib.decompress(content) if isinstance(content, bytes) else content.encode()
+    return git_blob_sha(data)
+
+SQL_MIGRATE_COMIT = '''
+    INSERT OR IGNORE INTO blob (sha, content)
+        SELECT stored_blob_sha(content), content FROM comit_old;
+    INSERT INTO comit
+        (comit_id, sha, message, size, created, blob_sha, parents, file_id)
+        SELECT comit_id, sha, message, size, created, stored_blob_sha(content)
+             , replace(replace(parents, char(39), '"'), ', ', ','), file_id
+        FROM comit_old;
+    DROP TABLE comit_old;
+    '''
+
+if old_comit:
+    db.create_function('stored_blob_sha', 1, stored_blob_sha)
+    db.executescript('''
+        BEGIN IMMEDIATE;
+        ALTER TABLE comit RENAME TO comit_old;
+        DROP INDEX IF EXISTS idx_comit_file;
+        ''' + SQL_CREATE_TABLES + SQL_MIGRATE_COMIT + 'COMMIT;')
+else:
+    db.executescript(SQL_CREATE_TABLES)
+
+# If requested, the contents are also indexed in an FTS5 table with the trigram
+# tokenizer, so that arbitrary substrings can be searched for without scanning
+# every blob (e.g. "select sha from blob where rowid in (select rowid from
+# blob_fts where blob_fts match 'pragma')"). The index only refers to the rows
+# of the 'blob' table and is kept up-to-date by triggers. Compressed contents are
+# never indexed. If the index is added to an existing database, it is built once
+# from the blobs that are already stored.
+
+if args.fts:
+    new_fts = db.execute("select 1 from sqlite_master where name = 'blob_fts'"
+        ).fetchone() is None
+    try:
+        db.executescript('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS blob_fts USING fts5
+                (content, content='blob', tokenize='trigram');
+            CREATE TRIGGER IF NOT EXISTS blob_fts_insert AFTER INSERT ON blob
+            WHEN typeof(new.content) = 'text' BEGIN
+                INSERT INTO blob_fts (rowid, content) VALUES (new.rowid, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS blob_fts_delete AFTER DELETE ON blob
+            WHEN typeof(old.content) = 'text' BEGIN
+                INSERT INTO blob_fts (blob_fts, rowid, content)
+                VALUES ('delete', old.rowid, old.content);
+            END;
+            ''')
+    except sqlite3.OperationalError:
+        sys.exit(f'enable-fts needs SQLite 3.34 or newer with FTS5 '
+            f'(found {sqlite3.sqlite_version})')
+    if new_fts:
+        db.execute('''
+            INSERT INTO blob_fts (rowid, content)
+            SELECT rowid, content FROM blob WHERE typeof(content) = 'text'
+            ''')
+
+# All statements are executed on a single cursor. The SQL strings are defined
+# once, so sqlite3 can always reuse the prepared statements from its cache.
+
+cur = db.cursor()
+
+db_writer = ThreadPoolExecutor(max_workers=1)
+db_writes = []
+
+def write_db(fn, *args):
+    db_writes.append(db_writer.submit(fn, *args))
+
+def query_db(fn, *args):
+    return db_writer.submit(fn, *args).result()
+
+def sync_db():
+    writes = db_writes[:]
+    db_writes.clear()
+    for future in writes:
+        future.result()
+
+SQL_INSERT_REPO = '''
+    INSERT OR IGNORE INTO repo 
+        ( repo_id, name, full_name, description, url, fork
+        , owner_id, owner_login
+        )
+    VALUES (?,?,?,?,?,?,?,?)
+    '''
+
+SQL_INSERT_FILE = '''
+    INSERT OR IGNORE INTO file
+        (name, path, sha, repo_id)
+    VALUES (?,?,?,?)
+    '''
+
+SQL_INSERT_COMMITS = '''
+    INSERT OR IGNORE INTO comit
+        (sha, message, size, created, blob_sha, parents, file_id)
+    VALUES '''
+
+SQL_INSERT_BLOBS = '''
+    INSERT OR IGNORE INTO blob
+        (sha, content)
+    VALUES '''
+
+SQL_STORE_PAGE = '''
+    INSERT OR REPLACE INTO etag
+        (url, etag, link, body)
+    VALUES (?,?,?,?)
+    '''
+
+# The stored search pages are only needed until their stratum is finished. Like
+# everything else, they are written and looked up through the writer thread:
+# the API workers look up the ETag before a request, the main thread the stored
+# page after a 304.
+
+def stored_etag(url):
+    row = query_db(lambda: cur.execute(
+        "select etag from etag where url = ?", (url,)).fetchone())
+    return row[0] if row else None
+
+def store_page(res):
+    write_db(cur.execute, SQL_STORE_PAGE,
+        (res.url, res.headers['ETag'], res.headers.get('Link'), res.content))
+
+def restore_page(res):
+    link, body = query_db(lambda: cur.execute(
+        "select link, body from etag where url = ?", (res.url,)).fetchone())
+    res.status_code = 200
+    res._content = body
+    if link is not None:
+        res.headers['Link'] = link
+    return res
+
+def clear_pages():
+    write_db(cur.execute, 'DELETE FROM etag')
+
+# Many rows can be inserted with a single multi-row INSERT statement, as long as
+# the statement has no more than 999 parameters (the default limit of older
+# SQLite versions). Since most batches are full, sqlite3 can mostly reuse the
+# same prepared statement.
+
+MAX_SQL_VARIABLES = 999
+
+def insert_rows(sql, rows):
+    width = len(rows[0])
+    batch_size = MAX_SQL_VARIABLES // width
+    values = '(' + ','.join('?' * width) + ')'
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        cur.execute(sql + ','.join([values] * len(batch)),
+            [value for row in batch for value in row])
+
+# Many files of a search page tend to come from the same repos, so we remember
+# which repos are already stored and only insert the new ones.
 
 def insert_repo(repo):
-    db.execute('''
-        INSERT OR IGNORE INTO repo 
-            ( repo_id, name, full_name, description, url, fork
-            , owner_id, owner_login
-            )
-        VALUES (?,?,?,?,?,?,?,?)
-        ''',
-        ( repo['id']
-        , repo['name']
-        , repo['full_name']
-        , repo['description']
-        , repo['url']
-        , int(repo['fork'])
-        , repo['owner']['id']
-        , repo['owner']['login']
-        ))
-    db.commit()
+    if repo['id'] not in known_repos:
+        write_db(cur.execute, SQL_INSERT_REPO,
+            ( repo['id']
+            , repo['name']
+            , repo['full_name']
+            , repo['description']
+            , repo['url']
+            , int(repo['fork'])
+            , repo['owner']['id']
+            , repo['owner']['login']
+            ))
+        known_repos.add(repo['id'])
     global sam_repo, total_sam_repo
     sam_repo += 1
     total_sam_repo += 1
 
 # Here we insert a file into the results database. For further computations
-# we check the file_id after insertion and return it.
+# we check the file_id after insertion and return it. If the file was already
+# there (and the insert was ignored), 'lastrowid' doesn't belong to it, so we
+# look up the id of the existing row instead.
+
+SQL_SELECT_FILE_ID = 'SELECT file_id FROM file WHERE path = ? AND repo_id = ?'
+
+def insert_file_row(row):
+    cur.execute(SQL_INSERT_FILE, row)
+    if cur.rowcount == 1:
+        return cur.lastrowid
+    return cur.execute(SQL_SELECT_FILE_ID, (row[1], row[3])).fetchone()[0]
 
 def insert_file(file,repo_id):
-    local_cur = db.execute('''
-        INSERT OR IGNORE INTO file
-            (name, path, sha, repo_id)
-        VALUES (?,?,?,?)
-        ''',
+    file_id = query_db(insert_file_row,
         ( file['name']
         , file['path']
         , file['sha']
         , repo_id
         ))
-    file_id = local_cur.lastrowid
-    db.commit()
+    known_files.add((file['path'], repo_id))
     global sam_file, total_sam_file
     sam_file += 1
     total_sam_file += 1
@@ -473,36 +1159,71 @@ def insert_file(file,repo_id):
 # In order to get the byte size of the file content we check the length of the
 # content of the response object. The timestamp is stored as the string directly
 # from the API response, since sqlite can't store time objects anyway.
-# The parent field stores a list of git_shas that correspond to the parent commits.
-
-def insert_commit(commit,content_res,parents,file_id):
-    db.execute('''
-        INSERT OR IGNORE INTO comit
-            (sha, message, size, created, content, parents, file_id)
-        VALUES (?,?,?,?,?,?,?)
-        ''',
-        ( commit['sha']
-        , commit['commit']['message']
-        , len(content_res.content)
-        , commit['commit']['committer']['date']
-        , content_res.text
-        , str(parents)
-        , file_id
-        ))
-    db.commit()
+# The parent field stores a list of git_shas that correspond to the parent commits
+# as a compact JSON array.
+# Most commits of a file don't change its content, so the contents are stored
+# only once in the 'blob' table, keyed by their git blob sha (the same sha that
+# GitHub reports for a file), and the commits refer to them.
+# If requested, the content is stored as a zlib-compressed BLOB, which makes the
+# database a lot smaller since source code compresses well. The size is always
+# the size of the uncompressed content.
+# Since a whole page of commits is downloaded at once, we first collect one row
+# per commit and then insert all of them with a single statement.
+
+pending_blobs = []
+
+def encode_content(content_res):
+    return zlib.compress(content_res.content) if args.compress else content_res.text
+
+def store_blob(content_res):
+    sha = git_blob_sha(content_res.content)
+    if sha not in known_blobs:
+        pending_blobs.append((sha, encode_content(content_res)))
+        known_blobs.add(sha)
+    return sha
+
+def insert_blobs():
+    if pending_blobs:
+        write_db(insert_rows, SQL_INSERT_BLOBS, pending_blobs[:])
+        pending_blobs.clear()
+
+def commit_row(commit,size,blob_sha,parents,file_id):
+    return ( commit['sha']
+           , commit['commit']['message']
+           , size
+           , commit['commit']['committer']['date']
+           , blob_sha
+           , json.dumps(parents, separators=(',', ':'))
+           , file_id
+           )
+
+def insert_commits(rows):
+    if rows:
+        write_db(insert_rows, SQL_INSERT_COMMITS, rows)
+    known_commits.update((row[0], row[6]) for row in rows)
     global sam_comit, total_sam_comit
-    sam_comit += 1
-    total_sam_comit += 1
+    sam_comit += len(rows)
+    total_sam_comit += len(rows)
+
+# To decide whether a repo, file or commit has already been downloaded (e.g.
+# when continuing a previous search), we don't want to query the database for
+# every single item. Instead, we load the keys of all known repos, files and
+# commits into memory once and keep these sets up-to-date whenever we insert
+# something. The same goes for the size and blob of every commit of a path.
+
+known_repos = set(repo_id for (repo_id,) in cur.execute("select repo_id from repo"))
+known_files = set(cur.execute("select path, repo_id from file"))
+known_commits = set(cur.execute("select sha, file_id from comit"))
+known_blobs = set(sha for (sha,) in cur.execute("select sha from blob"))
+known_contents = {(sha, path): (size, blob_sha) for (sha, path, size, blob_sha) in
+    cur.execute("select comit.sha, file.path, comit.size, comit.blob_sha "
+                "from comit join file using (file_id)")}
 
 def known_file(item):
-    cur = db.execute("select count(*) from file where path = ? and repo_id = ?",
-        (item['path'], item['repository']['id']))
-    return cur.fetchone()[0] == 1
+    return (item['path'], item['repository']['id']) in known_files
 
 def known_commit(item, file_id):
-    cur = db.execute("select count(*) from comit where sha = ? and file_id = ?",
-        (item['sha'], file_id))
-    return cur.fetchone()[0] == 1
+    return (item['sha'], file_id) in known_commits
 
 #-------------------------------------------------------------------------------
 
@@ -534,12 +1255,11 @@ if os.path.isfile(args.statistics):
             total_sam_repo += sam_repo
             total_sam_file += sam_file
             total_sam_comit += sam_comit
-            clear_footer()
-            print_stratum()
-            print_footer()
+            redraw(overwrite=False)
+            finish_stratum()
         if pop_files > -1:
             strat_first += args.stratum_size
-            strat_last = min(strat_last + args.stratum_size, args.max_size)
+            strat_last = stratum_last(strat_first)
             pop_files = -1
             sam_repo = -1
             sam_file = -1
@@ -557,85 +1277,138 @@ stats = csv.writer(statsfile)
 # Let's also quickly define a signal handler to cleanly deal with Ctrl-C. If the
 # user quits the program and cancels the search, we want to allow him to later
 # continue more-or-less where he left of. So we need to properly close the
-# database and statistic file.
-
-def signal_handler(sig,frame):
-    db.commit()
-    db.close()
+# database and statistic file. The page of search results that was being
+# downloaded is rolled back, since its files might not have all of their commits
+# yet. Its stratum is not in the statistics file, so it will be sampled again
+# anyway. The same has to happen when the program is terminated (SIGTERM), fails
+# with an error or simply finishes, so 'shut_down' does all of this exactly once,
+# no matter how often it is called.
+
+# The signal handler itself only takes note of the signal (see 'check_interrupt'
+# above) and the actual shut down happens once the main loop has been left.
+# Should the shut down get stuck somehow, another Ctrl-C (or SIGTERM) ends the
+# program right away.
+
+def shut_down():
+    if stopping.is_set():
+        return
+    stopping.set()
+    api_pool.shutdown(wait=False, cancel_futures=True)
+    raw_pool.shutdown(wait=False, cancel_futures=True)
+    query_db(db.rollback)
+    query_db(db.close)
+    db_writer.shutdown()
     statsfile.flush()
     statsfile.close()
-    global start
-    global api_calls
-    print("\nThe program took " + time.strftime("%H:%M:%S", 
-        time.gmtime((time.time())-start)) + " to execute (Hours:Minutes:Seconds).")
-    print("The program has requested " + str(api_calls) + " API calls from github.\n")
-    sys.exit(0)
+    if log_file is not None:
+        log_file.close()
+    close_sessions()
+    if not LIVE_UI:
+        output(format_footer())
+    flush_output()
+
+def signal_handler(sig,frame):
+    global interrupted
+    if stopping.is_set():
+        signal.signal(sig, signal.SIG_DFL)
+        os.kill(os.getpid(), sig)
+    interrupted = True
 
 signal.signal(signal.SIGINT, signal_handler)
+signal.signal(signal.SIGTERM, signal_handler)
 
 #-------------------------------------------------------------------------------
 
-clear_footer()
-print_stratum()
-print_footer()
-
 # Iterating through all the strata, we want to sample as much as we can.
 
-while strat_first <= args.max_size:
-
-    pop_files = 0
-    sam_repo = 0
-    sam_file = 0
-    sam_comit = 0
-
-    update_status('Searching...')
-    res = search(strat_first, strat_last)
-    pop_files = int(res.json()['total_count'])
-    clear_footer()
-    print_stratum(overwrite=True)
-    print_footer()
-
-    download_all_files(res)
-
-    # To stretch the 1000-results-per-query limit, we can simply repeat the
-    # search with the sort order reversed, thus sampling the stratum population
-    # from both ends, so to speak. This gives us a maximum sample size of 2000
-    # per stratum.
-
-    if pop_files > 1000:
-        update_status('Repeating search with reverse sort order...')
-        res = search(strat_first, strat_last, order='desc')
+next_search = None
+
+try:
+    if strat_first <= args.max_size:
+        redraw(overwrite=False)
+
+    while strat_first <= args.max_size:
+
+        pop_files = 0
+        sam_repo = 0
+        sam_file = 0
+        sam_comit = 0
+
+        update_status('Searching...')
+        if next_search is None:
+            next_search = submit_search(strat_first, strat_last)
+        res = get_result(next_search)
+        page = res.json()
+        pop_files = int(page['total_count'])
+        redraw()
+
+        # To stretch the 1000-results-per-query limit, we can simply repeat the
+        # search with the sort order reversed, thus sampling the stratum
+        # population from both ends, so to speak. This gives us a maximum sample
+        # size of 2000 per stratum. If the first page already tells us that we
+        # will need it, the reverse search is requested right away, while we are
+        # still downloading.
+
+        reverse = None
+        if pop_files > 1000:
+            reverse = submit_search(strat_first, strat_last, order='desc')
+
+        # The search for the next stratum doesn't depend on this one, so it is
+        # requested ahead of time as well and will be ready when we get there.
+
+        next_first = strat_first + args.stratum_size
+        next_search = None
+        if next_first <= args.max_size:
+            next_search = submit_search(next_first, stratum_last(next_first))
+
+        download_all_files(res, page)
+
+        if pop_files > 1000:
+            update_status('Repeating search with reverse sort order...')
+            if reverse is None:
+                reverse = submit_search(strat_first, strat_last, order='desc')
+            res = get_result(reverse)
         
-        # Due to the instability of search results, we might get a different
-        # population count on the second query. We will take the maximum of the
-        # two population counts for this stratum as a conservative estimate.
-
-        pop2 = int(res.json()['total_count'])
-        pop_files = max(pop_files,pop2)
-        clear_footer()
-        print_stratum(overwrite=True)
-        print_footer()
-
-        download_all_files(res)
-
-    # After we've sampled as much as we could of the current strata, commit it
-    # to the table and move on to the next one.
-
-    stats.writerow([strat_first,strat_last,pop_files,sam_repo,sam_file,sam_comit])
-    statsfile.flush()
+            # Due to the instability of search results, we might get a
+            # different population count on the second query. We will take the
+            # maximum of the two population counts for this stratum as a
+            # conservative estimate.
+
+            page = res.json()
+            pop2 = int(page['total_count'])
+            pop_files = max(pop_files,pop2)
+            redraw()
+
+            download_all_files(res, page)
+
+        # After we've sampled as much as we could of the current strata, commit
+        # it to the table and move on to the next one. The row is written by the
+        # database writer thread as well, right after the data of the stratum,
+        # so the statistics never get ahead of the database.
+
+        write_db(stats.writerow,
+            [strat_first,strat_last,pop_files,sam_repo,sam_file,sam_comit])
+        write_db(statsfile.flush)
+        clear_pages()
+        finish_stratum()
     
-    strat_first += args.stratum_size
-    strat_last = min(strat_last + args.stratum_size, args.max_size)
-    pop_files = -1
-    sam_repo = -1
-    sam_file = -1
-    sam_comit = -1
-
-    clear_footer()
-    print_stratum()
-    print_footer()
-
-update_status('Done.')
+        strat_first += args.stratum_size
+        strat_last = stratum_last(strat_first)
+        pop_files = -1
+        sam_repo = -1
+        sam_file = -1
+        sam_comit = -1
+
+        if strat_first <= args.max_size:
+            redraw(overwrite=False)
+
+    sync_db()
+    update_status('Done.')
+except KeyboardInterrupt:
+    pass
+finally:
+    shut_down()
+
 print("The program took " + time.strftime("%H:%M:%S", time.gmtime((time.time())-start)) + 
     " to execute (Hours:Minutes:Seconds).")
 print("The program has requested " + str(api_calls) + " API calls from GitHub.\n\n")